@@ -3,16 +3,20 @@
 Auto-anchor utils
 """
 
-import random
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import torch
 import yaml
 from tqdm import tqdm
 
-from utils.general import LOGGER, colorstr, emojis
-from utils.rboxs_utils import pi, poly2rbox, regular_theta
-import cv2
+from utils.general import LOGGER, NUM_THREADS, colorstr, emojis
+from utils.rboxs_utils import poly2hbb, poly2rbox_wh
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba not installed, anchor fitness falls back to NumPy
+    njit = None
 
 PREFIX = colorstr('AutoAnchor: ')
 
@@ -27,11 +31,139 @@ def check_anchor_order(m):
         m.anchors[:] = m.anchors.flip(0)
 
 
-def check_anchors(dataset, model, thr=4.0, imgsz=640):
+def label_edges(dataset, ratios, fast_wh=False):
+    """
+    Args:
+        dataset: Dataset.labels (list): n_imgs * array(num_gt_perimg, [cls_id, poly])
+        ratios (array): (n_imgs), per-image resize ratio
+        fast_wh (bool): use the axis-aligned box edges of each poly instead of its min area rect
+    Returns:
+        edges (array): (num_gts, [long_edge, short_edge]) of all labels in pixels
+    """
+    counts = np.fromiter((len(l) for l in dataset.labels), dtype=np.int64, count=len(dataset.labels))
+    polys = np.concatenate([l[:, 1:] for l in dataset.labels], 0).reshape(-1, 8)
+    key = (hash(counts.tobytes()), hash(polys.tobytes()), polys.dtype.str, fast_wh)  # stale if any poly changes
+    fn = (lambda p: np.sort(poly2hbb(p)[:, 2:4], 1)[:, ::-1]) if fast_wh else poly2rbox_wh
+    cache = getattr(dataset, '_autoanchor_cache', None)
+    if cache is None or cache[0] != key:  # rbox edges scale linearly with the poly, so cache them once at ratio 1
+        chunks = np.array_split(polys, max(1, -(-len(polys) // 65536)))  # <= 64k polys each, NumPy releases the GIL
+        if len(chunks) > 1:
+            with ThreadPool(NUM_THREADS) as pool:
+                cache = key, np.concatenate(pool.map(fn, chunks), 0)
+        else:
+            cache = key, fn(polys)
+        dataset._autoanchor_cache = cache
+    return cache[1] * np.repeat(ratios, counts)[:, None]  # scale every edge by its image ratio in one shot
+
+
+def anchor_fitness_np(k, edges, thr, out=None):
+    """
+    Args:
+        k (array): (n, 2), anchors
+        edges (array): (2, M), label edges as contiguous float32 [widths, heights] rows
+        thr (float): ratio metric threshold, 1 / hyp['anchor_t']
+        out (array): (2, M, n), optional preallocated scratch buffer reused across calls
+    Returns:
+        fitness (float): mean of best ratio metric above thr
+    """
+    r = np.divide(edges[:, :, None], k.T[:, None], out=out)  # (2, M, n) width / height ratios
+    np.minimum(r, 1 / r, out=r)  # ratio metric, written back into the scratch buffer
+    best = np.minimum(r[0], r[1]).max(1)  # best_x
+    return (best * (best > thr)).mean()
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath={'nnan', 'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)  # no 'ninf'
+    def anchor_fitness_nb(kg, edges, thr):
+        # Numba version of anchor_fitness_np() for a population kg (B, n, 2) -> fitness (B), scores every candidate
+        # in one pass over edges with per-chunk partial sums
+        B, M, nc = kg.shape[0], edges.shape[1], 64  # candidates, edges, chunks
+        ikg = 1.0 / kg  # reciprocals hoisted out of the edge loop, the inner loop only multiplies
+        totals = np.zeros((nc, B))
+        for c in prange(nc):
+            for i in range(c * M // nc, (c + 1) * M // nc):
+                w, h = edges[0, i], edges[1, i]
+                iw, ih = 1.0 / w, 1.0 / h
+                for b in range(B):
+                    best = 0.0
+                    for j in range(kg.shape[1]):
+                        x = min(min(w * ikg[b, j, 0], kg[b, j, 0] * iw), min(h * ikg[b, j, 1], kg[b, j, 1] * ih))
+                        if x > best:
+                            best = x
+                    if best > thr:
+                        totals[c, b] += best
+        return totals.sum(0) / M
+
+
+def kmeans_pp(x, n):
+    """
+    Args:
+        x (array): (M, 2), whitened label edges
+        n (int): number of centers
+    Returns:
+        k (array): (n, 2), k-means++ initial centers, each drawn with probability D(x)^2
+    """
+    k = [x[np.random.randint(len(x))]]
+    d = ((x - k[0]) ** 2).sum(1)  # squared distance to the nearest chosen center
+    for _ in range(1, n):
+        k.append(x[np.random.choice(len(x), p=d / d.sum() if d.sum() > 0 else None)])
+        d = np.minimum(d, ((x - k[-1]) ** 2).sum(1))
+    return np.stack(k)
+
+
+def kmeans_np(x, k, iters=30):
+    """
+    Args:
+        x (array): (M, 2), whitened label edges
+        k (array): (n, 2), initial centers
+        iters (int): Lloyd iterations
+    Returns:
+        k (array): (n, 2), kmeans centers
+    """
+    k = k.copy()
+    for _ in range(iters):
+        i = ((x[:, None] - k[None]) ** 2).sum(2).argmin(1)  # nearest center
+        counts = np.bincount(i, minlength=len(k))
+        sums = np.stack([np.bincount(i, weights=x[:, 0], minlength=len(k)),
+                         np.bincount(i, weights=x[:, 1], minlength=len(k))], 1)
+        keep = counts > 0  # empty clusters keep their center
+        k[keep] = sums[keep] / counts[keep, None]
+    return k
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def kmeans_nb(x, k, iters=30):
+        # Numba version of kmeans_np(), specialized to d=2 with per-chunk partial sums reduced after each pass
+        k = k.copy()
+        M, n, nc = x.shape[0], k.shape[0], 64  # points, centers, chunks
+        for _ in range(iters):
+            sums, counts = np.zeros((nc, n, 2)), np.zeros((nc, n))
+            for c in prange(nc):
+                for i in range(c * M // nc, (c + 1) * M // nc):
+                    w, h = x[i, 0], x[i, 1]
+                    best, jb = np.inf, 0
+                    for j in range(n):
+                        dw, dh = w - k[j, 0], h - k[j, 1]
+                        d = dw * dw + dh * dh
+                        if d < best:
+                            best, jb = d, j
+                    sums[c, jb, 0] += w
+                    sums[c, jb, 1] += h
+                    counts[c, jb] += 1
+            sums, counts = sums.sum(0), counts.sum(0)
+            for j in range(n):
+                if counts[j] > 0:  # empty clusters keep their center
+                    k[j, 0], k[j, 1] = sums[j, 0] / counts[j], sums[j, 1] / counts[j]
+        return k
+
+
+def check_anchors(dataset, model, thr=4.0, imgsz=640, fast_wh=False):
     """
     Args:
         Dataset.labels (list): n_imgs * array(num_gt_perimg, [cls_id, poly])
         Dataset.shapes (array): (n_imgs, [ori_img_width, ori_img_height])
+        fast_wh (bool): approximate label edges with axis-aligned boxes, skipping the min area rect fit
     Returns:
         
     """
@@ -42,24 +174,23 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
     scales = np.random.uniform(0.9, 1.1, size=(min_ratios.shape[0], 1))  # augment scale
 
     # wh = torch.tensor(np.concatenate([l[:, 3:5] * s for s, l in zip(shapes * scale, dataset.labels)])).float()  # wh
-    ls_edges = []
-    for ratio, labels in zip(min_ratios * scales, dataset.labels): # labels (array): (num_gt_perimg, [cls_id, poly])
-        rboxes = poly2rbox(labels[:, 1:] * ratio)
-        if len(rboxes):
-            ls_edges.append(rboxes[:, 2:4])
-    ls_edges = torch.tensor(np.concatenate(ls_edges)).float()
+    device = m.anchors.device  # keep the metric on the model device, no .cpu() copies or syncs per call
+    ls_edges = label_edges(dataset, (min_ratios * scales)[:, 0], fast_wh)
+    ls_edges = torch.tensor(ls_edges, dtype=torch.float32, device=device)
     ls_edges = ls_edges[(ls_edges >= 5.0).any(1)]  # filter > 5 pixels, anchor 宽高不能都小于5
+    lw, lh = ls_edges.T.contiguous().log()  # SoA log edge widths, heights
 
     def metric(k):  # compute metric
-        r = ls_edges[:, None] / k[None]
-        x = torch.min(r, 1 / r).min(2)[0]  # ratio metric
-        best = x.max(1)[0]  # best_x
-        aat = (x > 1 / thr).float().sum(1).mean()  # anchors above threshold
-        bpr = (best > 1 / thr).float().mean()  # best possible recall
+        lk = torch.as_tensor(k, dtype=lw.dtype, device=device).log()
+        d = torch.max((lw[:, None] - lk[:, 0]).abs(), (lh[:, None] - lk[:, 1]).abs())  # log ratio, x = exp(-d)
+        above = d < np.log(thr)  # x > 1 / thr
+        aat = above.float().sum(1).mean()  # anchors above threshold
+        bpr = above.any(1).float().mean()  # best possible recall
         return bpr, aat
 
-    anchors = m.anchors.clone() * m.stride.to(m.anchors.device).view(-1, 1, 1)  # current anchors
-    bpr, aat = metric(anchors.cpu().view(-1, 2))
+    stride = m.stride.to(device).view(-1, 1, 1)
+    anchors = (m.anchors * stride).view(-1, 2)  # current anchors
+    bpr, aat = (x.item() for x in metric(anchors))
     s = f'\n{PREFIX}{aat:.2f} anchors/target, {bpr:.3f} Best Possible Recall (BPR). '
     if bpr > 0.98:  # threshold to recompute
         LOGGER.info(emojis(f'{s}Current anchors are a good fit to dataset ✅'))
@@ -67,20 +198,22 @@ def check_anchors(dataset, model, thr=4.0, imgsz=640):
         LOGGER.info(emojis(f'{s}Anchors are a poor fit to dataset ⚠️, attempting to improve...'))
         na = m.anchors.numel() // 2  # number of anchors
         try:
-            anchors = kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False)
+            anchors = kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False, fast_wh=fast_wh,
+                                    device=device)
         except Exception as e:
             LOGGER.info(f'{PREFIX}ERROR: {e}')
-        new_bpr = metric(anchors)[0]
+        new_bpr = metric(anchors)[0].item()
         if new_bpr > bpr:  # replace anchors
-            anchors = torch.tensor(anchors, device=m.anchors.device).type_as(m.anchors)
-            m.anchors[:] = anchors.clone().view_as(m.anchors) / m.stride.to(m.anchors.device).view(-1, 1, 1)  # loss, featuremap stride pixel
+            anchors = torch.as_tensor(anchors, device=device).type_as(m.anchors)
+            m.anchors[:] = anchors.clone().view_as(m.anchors) / stride  # loss, featuremap stride pixel
             check_anchor_order(m)
             LOGGER.info(f'{PREFIX}New anchors saved to model. Update model *.yaml to use these anchors in the future.')
         else:
             LOGGER.info(f'{PREFIX}Original anchors better than new anchors. Proceeding with original anchors.')
 
 
-def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True):
+def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=1000, verbose=True, fast_wh=False,
+                  device='cpu'):
     """ Creates kmeans-evolved anchors from training dataset
 
         Arguments:
@@ -88,8 +221,10 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
             n: number of anchors
             img_size: image size used for training
             thr: anchor-label wh ratio threshold hyperparameter hyp['anchor_t'] used for training, default=4.0
-            gen: generations to evolve anchors using genetic algorithm
+            gen: generations to evolve anchors using genetic algorithm, stopped early on plateau
             verbose: print all results
+            fast_wh: approximate label edges with axis-aligned boxes, skipping the min area rect fit
+            device: device to evolve anchors on, a CUDA device runs the batched FP16 GA
 
         Return:
             k: kmeans evolved anchors
@@ -97,20 +232,26 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
         Usage:
             from utils.autoanchor import *; _ = kmean_anchors()
     """
-    from scipy.cluster.vq import kmeans
-
     thr = 1 / thr
 
-    def metric(k, wh):  # compute metrics
-        r = wh[:, None] / k[None]
-        x = torch.min(r, 1 / r).min(2)[0]  # ratio metric
+    def metric(k, le):  # compute metrics, le (2, M) log edge widths, heights
+        lk = torch.as_tensor(k, dtype=le.dtype).log()
+        d = torch.max((le[0, :, None] - lk[:, 0]).abs(), (le[1, :, None] - lk[:, 1]).abs())  # log ratio
+        x = d.neg_().exp_()  # ratio metric
         # x = wh_iou(wh, torch.tensor(k))  # iou metric
         return x, x.max(1)[0]  # x, best_x
 
-    def anchor_fitness(k):  # mutation fitness
-        # _, best = metric(torch.tensor(k, dtype=torch.float32), wh)
-        _, best = metric(torch.tensor(k, dtype=torch.float32), ls_edges)
-        return (best * (best > thr).float()).mean()  # fitness
+    def anchor_fitness(kg):  # mutation fitness, kg (n, 2) or population (B, n, 2) -> (B)
+        kg = kg.reshape(-1, n, 2).astype(np.float32)
+        if njit is not None:
+            return anchor_fitness_nb(kg, ls_edges_np, thr)  # whole population in one pass over edges
+        return np.array([anchor_fitness_np(x, ls_edges_np, thr, out=scratch) for x in kg])  # fitness
+
+    def anchor_fitness_batch(kg):  # batched mutation fitness on GPU, kg (B, n, 2) -> (B)
+        kg = kg.half()
+        rw, rh = ls_edges_gpu[0, None, :, None] / kg[:, None, :, 0], ls_edges_gpu[1, None, :, None] / kg[:, None, :, 1]
+        best = torch.min(torch.min(rw, 1 / rw), torch.min(rh, 1 / rh)).amax(2).float()  # (B, M) best_x
+        return (best * (best > thr)).mean(1)
 
     def print_results(k, verbose=True):
         k = k[np.argsort(k.prod(1))]  # sort small to large
@@ -136,14 +277,9 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
     # shapes = img_size * dataset.shapes / dataset.shapes.max(1, keepdims=True)
     # wh0 = np.concatenate([l[:, 3:5] * s for s, l in zip(shapes, dataset.labels)])  # wh
     min_ratios = img_size  / dataset.shapes.max(1, keepdims=True) # 
-    ls_edges0 = []
-    print(dataset.labels)
-    for ratio, labels in zip(min_ratios, dataset.labels): # labels (array): (num_gt_perimg, [cls_id, poly])
-        rboxes = poly2rbox(labels[:, 1:] * ratio)
-        if len(rboxes):
-            ls_edges0.append(rboxes[:, 2:4])
-    ls_edges0 = np.concatenate(ls_edges0)
-    print(ls_edges0)
+    ls_edges0 = label_edges(dataset, min_ratios[:, 0], fast_wh)
+    if verbose:
+        LOGGER.debug(f'{PREFIX}labels: {len(dataset.labels)} images, {len(ls_edges0)} polys')
     # Filter
     i = (ls_edges0 < 5.0).any(1).sum()
     if i:
@@ -158,13 +294,26 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
     # k, dist = kmeans(wh / s, n, iter=30)  # points, mean distance
     LOGGER.info(f'{PREFIX}Running kmeans for {n} anchors on {len(ls_edges)} points...')
     s = ls_edges.std(0)  # sigmas for whitening
-    k, dist = kmeans(ls_edges / s, n, iter=30)  # points, mean distance
-    assert len(k) == n, f'{PREFIX}ERROR: scipy.cluster.vq.kmeans requested {n} points but returned only {len(k)}'
+    try:  # sklearn k-means++ init and multi-threaded Lloyd/Elkan, much faster than scipy on large label sets
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+        if len(ls_edges) > 50000:  # mini-batch updates on very large label sets, the GA below polishes the centers
+            km = MiniBatchKMeans(n_clusters=n, init='k-means++', batch_size=4096, n_init=3, max_iter=30)
+        else:
+            km = KMeans(n_clusters=n, init='k-means++', n_init=3, max_iter=30, tol=1e-4)
+        k = km.fit(ls_edges / s).cluster_centers_
+    except ImportError:  # sklearn not installed, Lloyd iterations with a d=2 specialized kernel
+        x = np.ascontiguousarray(ls_edges / s)
+        k = kmeans_pp(x, n)  # k-means++ init needs far fewer Lloyd iterations than random init
+        k = kmeans_np(x, k, 10) if njit is None else kmeans_nb(x, k, 10)
+    assert len(k) == n, f'{PREFIX}ERROR: kmeans requested {n} points but returned only {len(k)}'
     k *= s
     # wh = torch.tensor(wh, dtype=torch.float32)  # filtered
     # wh0 = torch.tensor(wh0, dtype=torch.float32)  # unfiltered
-    ls_edges = torch.tensor(ls_edges, dtype=torch.float32)  # filtered
-    ls_edges0 = torch.tensor(ls_edges0, dtype=torch.float32)  # unfiltered
+    # FP32 even without numba: NumPy has no native FP16 arithmetic, FP16 edges would be upcast on every fitness call
+    ls_edges_np = np.ascontiguousarray(ls_edges.T, dtype=np.float32)  # filtered (2, M) widths/heights, for GA fitness
+    ls_edges_np.clip(min=1e-3, out=ls_edges_np)  # degenerate 0 short edges pass the filter, keep 1 / edge finite
+    scratch = np.empty((2, len(ls_edges), n), dtype=np.float32) if njit is None else None  # fitness buffer
+    ls_edges0 = torch.tensor(ls_edges0.T, dtype=torch.float32).contiguous().log()  # unfiltered (2, M) log edges
     k = print_results(k, verbose=False)
 
     # Plot
@@ -180,19 +329,52 @@ def kmean_anchors(dataset='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen
     # fig.savefig('wh.png', dpi=200)
 
     # Evolve
-    npr = np.random
-    f, sh, mp, s = anchor_fitness(k), k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
+    f, sh, mp, s = anchor_fitness(k)[0], k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
+    stall, patience = 0, 100  # generations without improvement, early stop after patience stalled generations
     pbar = tqdm(range(gen), desc=f'{PREFIX}Evolving anchors with Genetic Algorithm:')  # progress bar
-    for _ in pbar:
-        v = np.ones(sh)
-        while (v == 1).all():  # mutate until a change occurs (prevent duplicates)
-            v = ((npr.random(sh) < mp) * random.random() * npr.randn(*sh) * s + 1).clip(0.3, 3.0)
-        kg = (k.copy() * v).clip(min=2.0)
-        fg = anchor_fitness(kg)
-        if fg > f:
-            f, k = fg, kg.copy()
-            pbar.desc = f'{PREFIX}Evolving anchors with Genetic Algorithm: fitness = {f:.4f}'
-            if verbose:
-                print_results(k, verbose)
+    device = torch.device(device)
+    if device.type == 'cuda':  # evaluate a batch of B mutations per generation in one FP16 broadcast
+        ls_edges_gpu = torch.from_numpy(ls_edges_np).to(device).half()  # (2, M)
+        B = int(np.clip(2 ** 26 // (len(ls_edges) * n), 1, 64))  # population size, bounds (B, M, n) temporaries
+        k = torch.tensor(k, dtype=torch.float32, device=device)
+        f = anchor_fitness_batch(k[None])[0].item()
+        v = ((torch.rand((gen, B, *sh), device=device) < mp) * torch.rand((gen, B, 1, 1), device=device) *
+             torch.randn((gen, B, *sh), device=device) * s + 1).clamp_(0.3, 3.0)  # all mutations drawn up front
+        for g in pbar:
+            kg = (k * v[g]).clamp_(min=2.0)
+            fg, i = anchor_fitness_batch(kg).max(0)
+            if fg > f:
+                f, k, stall = fg.item(), kg[i], 0
+                pbar.desc = f'{PREFIX}Evolving anchors with Genetic Algorithm: fitness = {f:.4f}'
+                if verbose:
+                    print_results(k.cpu().numpy(), verbose)
+            else:
+                stall += 1
+                if stall >= patience:  # fitness plateaued
+                    break
+        k = k.cpu().numpy()
+    else:
+        # population size, without numba one candidate per generation: each NumPy candidate is a full (M, n) pass
+        B = 8 if njit is not None else 1
+        rng = np.random.default_rng(np.random.randint(2 ** 31))  # seeded from np.random, see init_seeds()
+        mask = rng.random((gen * B, *sh)) < mp  # all mutations drawn up front
+        flat = mask.reshape(gen * B, k.size)  # explicit width, gen may be 0
+        empty = ~flat.any(1)  # force at least one mutation per candidate (prevent duplicates)
+        flat[empty, rng.integers(k.size, size=empty.sum())] = True
+        v = (mask * rng.random((gen * B, 1, 1)) * rng.standard_normal((gen * B, *sh)) * s + 1).clip(0.3, 3.0)
+        v = v.reshape(gen, B, *sh)
+        for g in pbar:
+            kg = (k * v[g]).clip(min=2.0)  # (B, n, 2)
+            fg = anchor_fitness(kg)
+            i = fg.argmax()
+            if fg[i] > f:
+                f, k, stall = fg[i], kg[i].copy(), 0
+                pbar.desc = f'{PREFIX}Evolving anchors with Genetic Algorithm: fitness = {f:.4f}'
+                if verbose:
+                    print_results(k, verbose)
+            else:
+                stall += 1
+                if stall >= patience:  # fitness plateaued
+                    break
 
     return print_results(k)
@@ -80,6 +80,32 @@ def poly2rbox(polys, num_cls_thata=180, radius=6.0, use_pi=False, use_gaussian=F
         return np.array(rboxes), np.array(csl_labels)
     return np.array(rboxes)
 
+def poly2rbox_wh(polys):
+    """
+    Trans poly format to rbox edges only, skipping the center and θ computed by poly2rbox.
+    Args:
+        polys (array): (num_gts, [x1 y1 x2 y2 x3 y3 x4 y4]) 
+
+    Returns:
+        edges (array): (num_gts, [l s]), the long and short edge of the min area rect
+    """
+    assert polys.shape[-1] == 8
+    pts = polys.reshape(-1, 1, 4, 2).astype(np.float64) # (num, 1, 4, 2)
+    i, j = np.triu_indices(4, 1) # 6 point pairs, each convex hull edge is one of them
+    u = pts[:, 0, j] - pts[:, 0, i] # (num, 6, 2) candidate rect directions
+    norm = np.linalg.norm(u, axis=-1, keepdims=True)
+    u = u / np.where(norm > 0, norm, 1)
+    v = np.stack((-u[..., 1], u[..., 0]), axis=-1) # normal directions
+    pu = (pts * u[:, :, None]).sum(-1) # (num, 6, 4) projections
+    pv = (pts * v[:, :, None]).sum(-1)
+    w = pu.max(-1) - pu.min(-1) # (num, 6)
+    h = pv.max(-1) - pv.min(-1)
+    area = np.where(norm[..., 0] > 0, w * h, np.inf)
+    best = area.argmin(1) # min area rect is flush with a convex hull edge
+    idx = np.arange(len(pts))
+    w, h = w[idx, best], h[idx, best]
+    return np.stack((np.maximum(w, h), np.minimum(w, h)), axis=1)
+
 # def rbox2poly(rboxes):
 #     """
 #     Trans rbox format to poly format.